@@ -11,11 +11,17 @@ import { SupabaseClient, RealtimePostgresChangesPayload } from '@supabase/supaba
 export interface ProcessCreditReportRequest {
   pdf_url: string;
   user_id: string;
+  /** Defaults to true. false returns before the row is stored (2nd gen, no CPU throttling only). */
+  return_record?: boolean;
+  reprocess?: boolean;
+  /** When true the response is the dispute letter as a text/plain stream, not a ProcessCreditReportResponse. */
+  stream_letter?: boolean;
 }
 
 export interface ProcessCreditReportResponse {
   status: 'success' | 'error';
   message: string;
+  cached?: boolean;
   data?: CreditReportAnalysis[];
   summary?: {
     violations_found: number;
@@ -28,6 +34,7 @@ export interface CreditReportAnalysis {
   id: string;
   user_id: string;
   pdf_url: string;
+  pdf_sha256: string | null;
   extracted_text: string;
   parsed_data: ParsedCreditReportData;
   violations: Violation[];
@@ -65,6 +72,15 @@ export interface CreditInquiry {
 }
 
 export interface Violation {
+  violation_type:
+    | 'fcra_obsolete_info'
+    | 'fcra_accuracy'
+    | 'fcra_incomplete_info'
+    | 'metro2_format_error'
+    | 'duplicate_account'
+    | 'inaccurate_balance'
+    | 'mixed_file'
+    | 'incorrect_personal_info';
   title: string;
   description: string;
   affected_account: string;
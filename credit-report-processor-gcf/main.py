@@ -1,36 +1,145 @@
 import os
-import json
+import orjson
+import asyncio
+import threading
+import hashlib
+import contextvars
+import queue
+import uuid
+import contextlib
 import functions_framework
-from google.cloud import vision
+from flask import Response, stream_with_context
+from google.cloud import storage, vision
 import google.generativeai as genai
-import PyPDF2
-import io
+from google.api_core.exceptions import DeadlineExceeded, NotFound, ResourceExhausted, ServiceUnavailable
 import logging
-from supabase import create_client, Client
-import requests
-from dataclasses import dataclass
+import httpx
+from pydantic import BaseModel, Field, TypeAdapter
 from datetime import date, datetime
 from enum import Enum
+from typing import Awaitable, Callable, TypeVar
+from tenacity import (AsyncRetrying, before_sleep_log, retry_if_exception, retry_if_exception_type,
+                      stop_after_attempt, wait_exponential_jitter)
 
 # --- Configuration --- #
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")  # Use your service_role key for backend operations
+# Optional GCS bucket for staging PDFs so Vision reads them server-side instead of receiving inline bytes
+OCR_STAGING_BUCKET = os.getenv("OCR_STAGING_BUCKET")
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Long-lived event loop for all network I/O. The Flask handler stays synchronous and submits
+# coroutines here, so async clients and their pooled connections survive across invocations.
+# The loop thread is started on first use, not at import: functions-framework's gunicorn server
+# imports this module in the master process and then forks workers, and threads do not survive
+# a fork.
+_event_loop: asyncio.AbstractEventLoop | None = None
+_event_loop_pid: int | None = None
+_event_loop_lock = threading.Lock()
 
-# Initialize Google Cloud Vision AI client (automatically uses GOOGLE_APPLICATION_CREDENTIALS)
-vision_client = vision.ImageAnnotatorClient()
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Returns this process's I/O loop, starting its thread on first use."""
+    global _event_loop, _event_loop_pid
+    with _event_loop_lock:
+        if _event_loop is None or _event_loop_pid != os.getpid():
+            _event_loop = asyncio.new_event_loop()
+            _event_loop_pid = os.getpid()
+            threading.Thread(target=_event_loop.run_forever, name="credit-report-io", daemon=True).start()
+    return _event_loop
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop and blocks until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+# Google Cloud Vision AI client (automatically uses GOOGLE_APPLICATION_CREDENTIALS), created lazily
+# for the same reason as the loop
+_vision_client: vision.ImageAnnotatorAsyncClient | None = None
+
+def get_vision_client() -> vision.ImageAnnotatorAsyncClient:
+    """Returns the Vision client. Call it on the I/O loop: gRPC asyncio channels are bound to the loop they are created on."""
+    global _vision_client
+    if _vision_client is None:
+        _vision_client = vision.ImageAnnotatorAsyncClient()
+    return _vision_client
+
+# Initialize Cloud Storage client for PDF staging (only needed when a staging bucket is configured)
+storage_client = storage.Client() if OCR_STAGING_BUCKET else None
+
+# Reuse pooled HTTP/2 connections (and their TLS sessions) across warm invocations. All Supabase
+# access (PostgREST and Storage) goes through this client rather than the synchronous supabase-py.
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+)
+
+# PostgREST endpoint for direct, non-blocking table access with the service role key
+SUPABASE_REST_URL = f"{SUPABASE_URL}/rest/v1"
+SUPABASE_REST_HEADERS = {
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+}
+SUPABASE_STORAGE_URL = f"{SUPABASE_URL}/storage/v1"
+
+# Synchronous batch_annotate_files accepts at most 5 pages per file request
+VISION_PAGES_PER_REQUEST = 5
+# PDFs are downloaded (and staged to GCS) in chunks of this size
+PDF_DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# OCR output is cached in Supabase Storage as {sha256 of the PDF}.txt, one page per form feed
+OCR_CACHE_BUCKET = "ocr-cache"
+OCR_CACHE_PAGE_SEPARATOR = "\f"
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- Retries and Concurrency --- #
+
+# Transient failures worth retrying: Gemini quota (429), Vision/Gemini deadlines and 503s, and
+# Supabase or PDF host read timeouts
+RETRYABLE_EXCEPTIONS = (ResourceExhausted, DeadlineExceeded, ServiceUnavailable, httpx.ReadTimeout)
+
+# Cache reads and writes are best-effort: they are not retried, and give up quickly, so a slow
+# Supabase costs at most a cache miss rather than delaying the pipeline
+CACHE_REQUEST_TIMEOUT_SECONDS = 3
+
+# Caps in-flight Gemini calls per instance, so pipeline fan-out stays within per-project quotas
+GEMINI_MAX_CONCURRENCY = 8
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# Caps in-flight Vision requests per instance. Without a staging bucket each request carries the
+# whole PDF inline, so an unbounded page-window fan-out holds one copy of it per window.
+VISION_MAX_CONCURRENCY = 4
+vision_semaphore = asyncio.Semaphore(VISION_MAX_CONCURRENCY)
+
+T = TypeVar("T")
+
+def retrying(retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS)) -> AsyncRetrying:
+    """Up to 4 attempts with jittered exponential backoff; the last error is re-raised as-is."""
+    return AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_exponential_jitter(initial=0.5, max=8),
+        retry=retry,
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True,
+    )
+
+async def call_with_retries(func: Callable[..., Awaitable[T]], *args,
+                            limit: asyncio.Semaphore | None = None, **kwargs) -> T:
+    """Awaits `func(*args, **kwargs)`, retrying transient failures.
+
+    With `limit`, each attempt holds the semaphore while it runs, but not during backoff.
+    """
+    async for attempt in retrying():
+        with attempt:
+            async with limit or contextlib.nullcontext():
+                return await func(*args, **kwargs)
+
 # --- Data Models --- #
 
-class AccountStatus(Enum):
+class AccountStatus(str, Enum):
     CURRENT = "current"
     THIRTY_DAYS_LATE = "30_days_late"
     SIXTY_DAYS_LATE = "60_days_late"
@@ -41,236 +150,900 @@ class AccountStatus(Enum):
     CLOSED = "closed"
     PAID = "paid"
 
-class ViolationType(Enum):
+class ViolationType(str, Enum):
     FCRA_OBSOLETE_INFO = "fcra_obsolete_info"
     FCRA_ACCURACY = "fcra_accuracy"
     FCRA_INCOMPLETE_INFO = "fcra_incomplete_info"
     METRO2_FORMAT_ERROR = "metro2_format_error"
     DUPLICATE_ACCOUNT = "duplicate_account"
     INACCURATE_BALANCE = "inaccurate_balance"
+    MIXED_FILE = "mixed_file"
+    INCORRECT_PERSONAL_INFO = "incorrect_personal_info"
+
+class ViolationSeverity(str, Enum):
+    LOW = "LOW"
+    MEDIUM = "MEDIUM"
+    HIGH = "HIGH"
+    CRITICAL = "CRITICAL"
 
-class ViolationSeverity(Enum):
-    LOW = "low"
-    MEDIUM = "medium"
-    HIGH = "high"
-    CRITICAL = "critical"
+# Defaults fill in fields Gemini leaves out (e.g. an SSN that is not on the report), so a partial
+# answer still validates. Only the enum fields are left without one.
 
-@dataclass
-class PersonalInfo:
+class PersonalInfo(BaseModel):
     name: str = ""
     ssn: str = ""
     address: str = ""
     date_of_birth: str = ""
 
-@dataclass
-class CreditAccount:
+class CreditAccount(BaseModel):
     creditor_name: str = ""
     account_number: str = ""
     account_type: str = ""
     balance: float = 0.0
     credit_limit: float = 0.0
-    status: AccountStatus = AccountStatus.CURRENT
+    status: AccountStatus
     date_opened: str = ""
     last_activity: str = ""
 
-@dataclass
-class Inquiry:
+class Inquiry(BaseModel):
     company: str = ""
     date: str = ""
 
-@dataclass
-class CreditReport:
-    personal_info: PersonalInfo
-    accounts: list[CreditAccount]
-    inquiries: list[Inquiry]
-    raw_text: str
+class CreditReport(BaseModel):
+    personal_info: PersonalInfo = Field(default_factory=PersonalInfo)
+    accounts: list[CreditAccount] = Field(default_factory=list)
+    inquiries: list[Inquiry] = Field(default_factory=list)
 
-@dataclass
-class Violation:
+class Violation(BaseModel):
     violation_type: ViolationType
     severity: ViolationSeverity
-    title: str
-    description: str
+    title: str = ""
+    description: str = ""
     affected_account: str = ""
     legal_basis: str = ""
-    dispute_reason: str = "Inaccurate information"
+    dispute_reason: str = ""
+
+violation_list_adapter = TypeAdapter(list[Violation])
+
+def gemini_response_schema(annotation) -> dict:
+    """Converts a pydantic type to a Gemini response_schema in which every property is required.
+
+    The SDK's own conversion drops `required` and rejects field defaults, so it is not used here.
+    """
+    json_schema = TypeAdapter(annotation).json_schema()
+    definitions = json_schema.get("$defs", {})
+
+    def convert(node: dict) -> dict:
+        if "$ref" in node:
+            node = definitions[node["$ref"].rsplit("/", 1)[-1]]
+        if "enum" in node:
+            return {"type": "string", "enum": node["enum"]}
+        if node["type"] == "array":
+            return {"type": "array", "items": convert(node["items"])}
+        if node["type"] == "object":
+            properties = {name: convert(value) for name, value in node["properties"].items()}
+            return {"type": "object", "properties": properties, "required": list(properties)}
+        return {"type": node["type"]}
+
+    return convert(json_schema)
+
+# --- Gemini Models --- #
+
+# Initialize Gemini models once per instance. response_schema constrains the JSON models to the
+# data models above; the dispute letter is prose, so it gets a plain-text model.
+gemini_report_model = genai.GenerativeModel(
+    "gemini-1.5-flash",
+    generation_config=genai.GenerationConfig(
+        response_mime_type="application/json", response_schema=gemini_response_schema(CreditReport), temperature=0
+    ),
+)
+gemini_violations_model = genai.GenerativeModel(
+    "gemini-1.5-flash",
+    generation_config=genai.GenerationConfig(
+        response_mime_type="application/json", response_schema=gemini_response_schema(list[Violation]), temperature=0
+    ),
+)
+gemini_text_model = genai.GenerativeModel(
+    "gemini-1.5-flash",
+    generation_config=genai.GenerationConfig(temperature=0),
+)
+
+# --- Prompt Templates --- #
+
+# Accounts are independent for most violation types, so they are analyzed in parallel chunks
+VIOLATION_CHUNK_ACCOUNTS = 4
+
+# Inputs to the deterministic rule checks
+NEGATIVE_ACCOUNT_STATUSES = {
+    AccountStatus.THIRTY_DAYS_LATE,
+    AccountStatus.SIXTY_DAYS_LATE,
+    AccountStatus.NINETY_DAYS_LATE,
+    AccountStatus.ONE_TWENTY_DAYS_LATE,
+    AccountStatus.CHARGE_OFF,
+    AccountStatus.COLLECTION,
+}
+OBSOLETE_AFTER_DAYS = 7 * 365
+REQUIRED_ACCOUNT_FIELDS = ("creditor_name", "account_number", "account_type", "date_opened", "last_activity")
+
+# Stable instructions come first and per-request data is appended after PROMPT_DATA_SEPARATOR,
+# so identical prefixes are eligible for Gemini's implicit context caching.
+PROMPT_DATA_SEPARATOR = "\n\n---\n"
+
+def compact_json(data) -> str:
+    """Serializes prompt data without whitespace, which Gemini would otherwise bill as tokens."""
+    return orjson.dumps(data).decode()
+
+# Example output embedded in the parse instructions, serialized once at import
+PARSE_EXAMPLE_JSON = compact_json({
+    "personal_info": {
+        "name": "JOHN DOE",
+        "ssn": "123-45-6789",
+        "address": "123 MAIN ST, ANYTOWN, CA 90210",
+        "date_of_birth": "01/15/1980",
+    },
+    "accounts": [{
+        "creditor_name": "CHASE BANK",
+        "account_number": "****1234",
+        "account_type": "Revolving",
+        "balance": 2500.00,
+        "credit_limit": 5000.00,
+        "status": "current",
+        "date_opened": "01/15/2015",
+        "last_activity": "12/15/2023",
+    }],
+    "inquiries": [{"company": "BEST BUY", "date": "12/01/2023"}],
+})
+
+PARSE_PROMPT_PREFIX = """Extract the following structured information from the credit report text:
+- Personal Information: Name, SSN (format XXX-XX-XXXX), Address, Date of Birth (format MM/DD/YYYY).
+- Credit Accounts: For each account, extract Creditor Name, Account Number (last 4 digits if masked), Account Type (e.g., Revolving, Installment, Mortgage), Balance (float), Credit Limit (float), Status (one of: current, 30_days_late, 60_days_late, 90_days_late, 120_days_late, charge_off, collection, closed, paid), Date Opened (MM/DD/YYYY), Last Activity Date (MM/DD/YYYY).
+- Inquiries: For each inquiry, extract the Company and Date (MM/DD/YYYY).
+
+Return the data as a JSON object. Ensure all dates are in MM/DD/YYYY format. If a field is not found, use an empty string or 0.0 for numbers.
+The text may be a subset of the report's pages; extract only what appears in it and leave the rest empty.
+
+Example JSON structure:
+""" + PARSE_EXAMPLE_JSON + """
+
+The credit report text follows the separator."""
+
+VIOLATIONS_PROMPT_PREFIX = """Analyze the following structured credit report data for potential violations of the Fair Credit Reporting Act (FCRA) and Metro 2 reporting standards.
+
+Consider the following violation types, which require judgement:
+- **Inaccurate Account Status:** Account status (e.g., '30_days_late', 'charge_off') is inconsistent with the rest of the account's data.
+- **Mixed File:** Information belonging to another person is on this report (harder to detect without cross-referencing).
+- **Incorrect Personal Information:** Mismatched names, addresses, or SSN errors.
+- **Inaccurate Balances/Limits:** Reported balance or credit limit is incorrect.
+
+For each potential violation, provide a JSON object with the following keys:
+- `violation_type`: One of "fcra_accuracy", "metro2_format_error", "inaccurate_balance", "mixed_file" or "incorrect_personal_info".
+- `title`: A concise title for the violation (e.g., "Mixed File Account").
+- `description`: A detailed explanation of why it's a violation, referencing the specific data points.
+- `affected_account`: The creditor name and account number (if applicable).
+- `legal_basis`: Reference to the relevant FCRA section (e.g., "FCRA 607(b)" for maximum possible accuracy, "FCRA 623(a)" for furnisher accuracy) or Metro 2 rule.
+- `severity`: "LOW", "MEDIUM", "HIGH", or "CRITICAL".
+- `dispute_reason`: A brief reason for dispute (e.g., "Account does not belong to me").
+
+Return a JSON array of violation objects. If no violations are found, return an empty array `[]`.
+The data may contain only some of the report's accounts. Obsolete information, duplicate accounts, zero-balance accounts with a late status and missing account fields are detected separately by fixed rules, so do not report them.
+
+The credit report data (JSON) follows the separator."""
+
+LETTER_PROMPT_PREFIX = """Generate a formal dispute letter to a credit bureau based on the personal information and detected credit report violations that follow the separator.
+
+The letter should:
+- Be addressed to a generic credit bureau (e.g., "To: [Credit Bureau Name]").
+- Clearly state the consumer's name and SSN.
+- Reference the Fair Credit Reporting Act (FCRA).
+- List each violation with its description, affected account, and legal basis.
+- Request investigation and removal/correction of inaccurate information.
+- Include a closing statement for prompt attention.
+- Do NOT include placeholders for signature or printed name at the end, as the user will add those."""
+
+# --- Gemini Response Cache --- #
+
+GEMINI_CACHE_TABLE = "gemini_response_cache"
+
+# Cached responses record the user they were generated for, so they are deleted with the user
+cache_user_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("cache_user_id", default=None)
+
+# Background cache writes, referenced until they finish so they are not garbage collected
+_cache_store_tasks: set[asyncio.Task] = set()
+
+async def _lookup_cached_response(cache_key: str) -> str | None:
+    response = await http_client.get(
+        f"{SUPABASE_REST_URL}/{GEMINI_CACHE_TABLE}",
+        timeout=CACHE_REQUEST_TIMEOUT_SECONDS,
+        params={"select": "response_text", "cache_key": f"eq.{cache_key}", "limit": "1"},
+        headers=SUPABASE_REST_HEADERS,
+    )
+    response.raise_for_status()
+    rows = orjson.loads(response.content)
+    if rows:
+        logger.info("Gemini cache hit.")
+        return rows[0]["response_text"]
+    return None
+
+async def generate_content_cached(model: genai.GenerativeModel, prompt: str,
+                                  on_chunk: Callable[[str], None] | None = None) -> str:
+    """Returns Gemini's response text for a prompt, serving repeats from the Supabase cache.
+
+    Prompts are matched exactly by SHA-256; near-matches are never served, since a similar report
+    (e.g. next month's from the same bureau) must not get another report's data back. Responses
+    are streamed, and `on_chunk` (if given) receives each piece of text as it arrives.
+    """
+    cache_key = hashlib.sha256(f"{model.model_name}\n{prompt}".encode()).hexdigest()
+    user_id = cache_user_id.get()
+
+    try:
+        cached = await _lookup_cached_response(cache_key)
+        if cached is not None:
+            if on_chunk:
+                on_chunk(cached)
+            return cached
+    except Exception as e:
+        # The cache is an optimization; never fail the request because of it
+        logger.warning(f"Gemini cache lookup failed: {e}")
+
+    # A failed stream is only retried if none of it has reached `on_chunk`, which cannot take text back
+    # The semaphore is taken per attempt, so backoff sleeps do not hold up other Gemini calls
+    text_chunks = []
+    async for attempt in retrying(retry_if_exception(
+        lambda e: isinstance(e, RETRYABLE_EXCEPTIONS) and not (on_chunk and text_chunks)
+    )):
+        with attempt:
+            text_chunks = []
+            async with gemini_semaphore:
+                response = await model.generate_content_async(prompt, stream=True)
+                async for chunk in response:
+                    if chunk.parts:
+                        text_chunks.append(chunk.text)
+                        if on_chunk:
+                            on_chunk(chunk.text)
+    response_text = "".join(text_chunks)
+    if response.candidates[0].finish_reason != genai.protos.Candidate.FinishReason.STOP:
+        # Truncated or filtered output must not be replayed to later requests
+        return response_text
+
+    # Storing is off the critical path; the caller continues while the upsert runs
+    store_task = asyncio.create_task(_store_cached_response(cache_key, user_id, response_text))
+    _cache_store_tasks.add(store_task)
+    store_task.add_done_callback(_cache_store_tasks.discard)
+    return response_text
+
+async def _store_cached_response(cache_key: str, user_id: str | None, response_text: str) -> None:
+    try:
+        response = await http_client.post(
+            f"{SUPABASE_REST_URL}/{GEMINI_CACHE_TABLE}",
+            timeout=CACHE_REQUEST_TIMEOUT_SECONDS,
+            content=orjson.dumps({
+                "cache_key": cache_key,
+                "user_id": user_id,
+                "response_text": response_text,
+            }),
+            headers={
+                **SUPABASE_REST_HEADERS,
+                "Content-Type": "application/json",
+                "Prefer": "resolution=merge-duplicates,return=minimal",
+            },
+        )
+        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"Gemini cache store failed: {e}")
 
 # --- Core AI Processing Logic --- #
 
-def extract_text_from_pdf_with_vision_ai(pdf_content: bytes) -> str:
-    """Extracts text from PDF content using Google Cloud Vision AI."""
+async def download_pdf(pdf_url: str) -> tuple[vision.InputConfig, storage.Blob | None, str]:
+    """Streams a PDF into the form Vision reads it from, hashing it (SHA-256) on the way.
+
+    With OCR_STAGING_BUCKET set, chunks are uploaded to a staging object while the next ones download
+    and Vision reads the object server-side; the blob is returned so the caller can delete it.
+    Otherwise the bytes are collected for an inline request. Interrupted downloads restart from the
+    beginning.
+    """
+    return await call_with_retries(_download_pdf_once, pdf_url)
+
+async def _download_pdf_once(pdf_url: str) -> tuple[vision.InputConfig, storage.Blob | None, str]:
+    digest = hashlib.sha256()
+    async with http_client.stream("GET", pdf_url) as pdf_response:
+        pdf_response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
+
+        if not OCR_STAGING_BUCKET:
+            pdf_content = bytearray()
+            async for chunk in pdf_response.aiter_bytes(PDF_DOWNLOAD_CHUNK_BYTES):
+                digest.update(chunk)
+                pdf_content += chunk
+            logger.info(f"Downloaded PDF content (size: {len(pdf_content)} bytes).")
+            return vision.InputConfig(content=bytes(pdf_content), mime_type="application/pdf"), None, digest.hexdigest()
+
+        blob = storage_client.bucket(OCR_STAGING_BUCKET).blob(f"ocr-staging/{uuid.uuid4()}.pdf")
+        # Resumable upload in 1 MiB parts (a multiple of the required 256 KiB); BlobWriter's default
+        # chunk would buffer 40 MiB and upload it all on close
+        writer = blob.open("wb", content_type="application/pdf", chunk_size=PDF_DOWNLOAD_CHUNK_BYTES)
+        pending_write: asyncio.Future | None = None
+        size = 0
+        try:
+            async for chunk in pdf_response.aiter_bytes(PDF_DOWNLOAD_CHUNK_BYTES):
+                digest.update(chunk)
+                size += len(chunk)
+                # Each chunk uploads while the next one downloads
+                if pending_write:
+                    await pending_write
+                pending_write = asyncio.ensure_future(asyncio.to_thread(writer.write, chunk))
+            if pending_write:
+                await pending_write
+            await asyncio.to_thread(writer.close)
+        except Exception:
+            if pending_write:
+                await asyncio.gather(pending_write, return_exceptions=True)
+            # Don't leave a partial upload behind when the download is retried or abandoned
+            with contextlib.suppress(NotFound):
+                await asyncio.to_thread(blob.delete)
+            raise
+
+    gcs_uri = f"gs://{OCR_STAGING_BUCKET}/{blob.name}"
+    logger.info(f"Staged PDF content at {gcs_uri} (size: {size} bytes).")
+    return vision.InputConfig(gcs_source=vision.GcsSource(uri=gcs_uri), mime_type="application/pdf"), blob, digest.hexdigest()
+
+async def load_cached_ocr_pages(pdf_sha256: str) -> list[str] | None:
+    """Returns the per-page OCR text stored for a PDF, or None if it has not been OCR'd before."""
+    try:
+        response = await http_client.get(
+            f"{SUPABASE_STORAGE_URL}/object/{OCR_CACHE_BUCKET}/{pdf_sha256}.txt",
+            timeout=CACHE_REQUEST_TIMEOUT_SECONDS,
+            headers=SUPABASE_REST_HEADERS,
+        )
+        if response.status_code in (400, 404):  # Storage reports missing objects as either
+            return None
+        response.raise_for_status()
+        return response.text.split(OCR_CACHE_PAGE_SEPARATOR)
+    except Exception as e:
+        logger.warning(f"OCR cache lookup failed: {e}")
+        return None
+
+async def store_cached_ocr_pages(pdf_sha256: str, page_texts: list[str]) -> None:
+    """Saves per-page OCR text so reprocessing the same PDF can skip Vision."""
+    try:
+        response = await http_client.post(
+            f"{SUPABASE_STORAGE_URL}/object/{OCR_CACHE_BUCKET}/{pdf_sha256}.txt",
+            timeout=CACHE_REQUEST_TIMEOUT_SECONDS,
+            content=OCR_CACHE_PAGE_SEPARATOR.join(page_texts).encode(),
+            headers={**SUPABASE_REST_HEADERS, "Content-Type": "text/plain; charset=utf-8", "x-upsert": "true"},
+        )
+        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"OCR cache store failed: {e}")
+
+async def queue_cached_ocr_pages(page_texts: list[str], page_queue: asyncio.Queue) -> None:
+    """Feeds cached OCR text into the pipeline in place of Vision."""
+    for page_number, text in enumerate(page_texts, start=1):
+        await page_queue.put((page_number, text))
+    await page_queue.put(None)
+
+async def _batch_annotate_pdf(input_config: vision.InputConfig, pages: list[int] | None) -> vision.BatchAnnotateFilesResponse:
+    # Built while holding vision_semaphore, since the request carries its own copy of inline PDF bytes
+    file_request = vision.AnnotateFileRequest(
+        input_config=input_config,
+        features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+        pages=pages or [],  # Vision defaults to the first 5 pages
+    )
+    return await get_vision_client().batch_annotate_files(requests=[file_request])
+
+async def _annotate_pdf_pages(input_config: vision.InputConfig, pages: list[int] | None = None) -> vision.AnnotateFileResponse:
+    """Runs DOCUMENT_TEXT_DETECTION on up to VISION_PAGES_PER_REQUEST pages of a PDF."""
+    response = await call_with_retries(_batch_annotate_pdf, input_config, pages, limit=vision_semaphore)
+    file_response = response.responses[0]
+    if file_response.error.message:
+        raise Exception(f"Vision AI error: {file_response.error.message}")
+    return file_response
+
+async def extract_pages_from_pdf_with_vision_ai(input_config: vision.InputConfig, page_queue: asyncio.Queue) -> None:
+    """OCRs every page of a PDF with Google Cloud Vision AI, queueing (page_number, text) as batches finish."""
     logger.info("Starting PDF text extraction with Vision AI...")
+
+    async def queue_pages(batch: vision.AnnotateFileResponse, first_page: int) -> None:
+        for offset, page_response in enumerate(batch.responses):
+            if page_response.error.message:
+                raise Exception(f"Vision AI error: {page_response.error.message}")
+            await page_queue.put((first_page + offset, page_response.full_text_annotation.text))
+
+    async def annotate_window(pages: list[int]) -> None:
+        await queue_pages(await _annotate_pdf_pages(input_config, pages), pages[0])
+
     try:
-        # For PDF processing, we need to convert to images first
-        # Vision AI works better with images than raw PDF bytes
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
-        
-        # For now, we'll process the first page as an image
-        # In production, you might want to process all pages
-        if len(pdf_reader.pages) == 0:
+        # The first batch also tells us how many pages the document has
+        # Vision already parses the PDF, so it doubles as the empty/corrupt document check
+        first_batch = await _annotate_pdf_pages(input_config)
+        total_pages = first_batch.total_pages
+        if total_pages == 0:
             raise ValueError("PDF has no pages")
-        
-        # Create image from PDF content
-        image = vision.Image(content=pdf_content)
-        
-        # Use DOCUMENT_TEXT_DETECTION for better OCR results
-        response = vision_client.document_text_detection(image=image)
-        
-        if response.error.message:
-            raise Exception(f"Vision AI error: {response.error.message}")
-        
-        if response.full_text_annotation:
-            logger.info("Text extraction successful.")
-            return response.full_text_annotation.text
-        else:
-            logger.warning("No full text annotation found in Vision AI response.")
-            return ""
+        await queue_pages(first_batch, 1)
+
+        # OCR the remaining pages in concurrent batches of VISION_PAGES_PER_REQUEST
+        page_windows = [
+            list(range(start, min(start + VISION_PAGES_PER_REQUEST, total_pages + 1)))
+            for start in range(VISION_PAGES_PER_REQUEST + 1, total_pages + 1, VISION_PAGES_PER_REQUEST)
+        ]
+        async with asyncio.TaskGroup() as tg:
+            for pages in page_windows:
+                tg.create_task(annotate_window(pages))
+
+        logger.info(f"Text extraction successful ({total_pages} pages).")
+        await page_queue.put(None)
     except Exception as e:
         logger.error(f"Error during Vision AI text extraction: {e}")
         raise
 
-def parse_credit_report_with_gemini(credit_report_text: str) -> dict:
+async def parse_credit_report_with_gemini(credit_report_text: str) -> dict:
     """Parses credit report text into structured data using Gemini."""
     logger.info("Starting credit report parsing with Gemini...")
-    model = genai.GenerativeModel("gemini-pro")  # Consider 'gemini-1.5-flash' for faster, cheaper inference
-    
-    prompt = f"""
-    Extract the following structured information from the credit report text:
-    - Personal Information: Name, SSN (format XXX-XX-XXXX), Address, Date of Birth (format MM/DD/YYYY).
-    - Credit Accounts: For each account, extract Creditor Name, Account Number (last 4 digits if masked), Account Type (e.g., Revolving, Installment, Mortgage), Balance (float), Credit Limit (float), Status (e.g., Current, 30 Days Late, Charge Off, Collection, Paid, Closed), Date Opened (MM/DD/YYYY), Last Activity Date (MM/DD/YYYY).
-    - Inquiries: For each inquiry, extract the Company and Date (MM/DD/YYYY).
-
-    Return the data as a JSON object. Ensure all dates are in MM/DD/YYYY format. If a field is not found, use an empty string or 0.0 for numbers.
+    prompt = PARSE_PROMPT_PREFIX + PROMPT_DATA_SEPARATOR + credit_report_text
 
-    Example JSON structure:
-    {{
-      "personal_info": {{
-        "name": "JOHN DOE",
-        "ssn": "123-45-6789",
-        "address": "123 MAIN ST, ANYTOWN, CA 90210",
-        "date_of_birth": "01/15/1980"
-      }},
-      "accounts": [
-        {{
-          "creditor_name": "CHASE BANK",
-          "account_number": "****1234",
-          "account_type": "Revolving",
-          "balance": 2500.00,
-          "credit_limit": 5000.00,
-          "status": "Current",
-          "date_opened": "01/15/2015",
-          "last_activity": "12/15/2023"
-        }}
-      ],
-      "inquiries": [
-        {{
-          "company": "BEST BUY",
-          "date": "12/01/2023"
-        }}
-      ]
-    }}
-
-    Credit Report Text:
-    {credit_report_text}
-    """
-    
     try:
-        response = model.generate_content(prompt)
-        # Attempt to extract JSON from potentially Markdown-wrapped response
-        json_str = response.text.strip()
-        if json_str.startswith("```json") and json_str.endswith("```"):
-            json_str = json_str[7:-3].strip()
-        elif json_str.startswith("```") and json_str.endswith("```"):
-            json_str = json_str[3:-3].strip()
-        
-        parsed_data = json.loads(json_str)
+        response_text = await generate_content_cached(gemini_report_model, prompt)
+        parsed_data = CreditReport.model_validate_json(response_text).model_dump(mode="json")
         logger.info("Credit report parsing with Gemini successful.")
         return parsed_data
     except Exception as e:
-        logger.error(f"Error parsing credit report with Gemini: {e}\nGemini Response: {response.text if 'response' in locals() else 'N/A'}")
+        logger.error(f"Error parsing credit report with Gemini: {e}\nGemini Response: {response_text if 'response_text' in locals() else 'N/A'}")
         raise
 
-def detect_violations_with_gemini(parsed_data: dict) -> list[dict]:
-    """Detects FCRA and Metro 2 violations using Gemini."""
-    logger.info("Starting violation detection with Gemini...")
-    model = genai.GenerativeModel("gemini-pro")
-    
-    data_str = json.dumps(parsed_data, indent=2)
+async def detect_violations_with_gemini(parsed_data: dict) -> list[dict]:
+    """Detects FCRA and Metro 2 violations using Gemini, analyzing small groups of accounts in parallel."""
+    accounts = parsed_data.get("accounts", [])
+    # Personal information and inquiries only need to be reviewed once, so they ride with the first chunk
+    chunks = [{
+        "personal_info": parsed_data.get("personal_info", {}),
+        "accounts": accounts[:VIOLATION_CHUNK_ACCOUNTS],
+        "inquiries": parsed_data.get("inquiries", []),
+    }]
+    chunks += [
+        {"accounts": accounts[start:start + VIOLATION_CHUNK_ACCOUNTS]}
+        for start in range(VIOLATION_CHUNK_ACCOUNTS, len(accounts), VIOLATION_CHUNK_ACCOUNTS)
+    ]
+    chunk_violations = await asyncio.gather(*[_detect_violations_chunk(chunk) for chunk in chunks])
+    return [violation for violations in chunk_violations for violation in violations]
+
+async def _detect_violations_chunk(parsed_data: dict) -> list[dict]:
+    logger.info(f"Starting violation detection with Gemini for {len(parsed_data['accounts'])} accounts...")
+    prompt = VIOLATIONS_PROMPT_PREFIX + PROMPT_DATA_SEPARATOR + compact_json(parsed_data)
 
-    prompt = f"""
-    Analyze the following structured credit report data for potential violations of the Fair Credit Reporting Act (FCRA) and Metro 2 reporting standards.
-    
-    Consider the following common violation types:
-    - **Obsolete Negative Information:** Negative items (e.g., late payments, charge-offs, collections) remaining on the report beyond their permissible reporting period (generally 7 years from delinquency date, bankruptcies 10 years).
-    - **Inaccurate Account Status:** Account status (e.g., '30 Days Late', 'Charge Off') does not match payment history or balance (e.g., zero balance with late status).
-    - **Incomplete Information:** Missing critical data fields for an account (e.g., date opened, last activity date, account type).
-    - **Duplicate Accounts:** The same account reported multiple times.
-    - **Mixed File:** Information belonging to another person is on this report (harder to detect without cross-referencing).
-    - **Incorrect Personal Information:** Mismatched names, addresses, or SSN errors.
-    - **Inaccurate Balances/Limits:** Reported balance or credit limit is incorrect.
-    
-    For each potential violation, provide a JSON object with the following keys:
-    - `title`: A concise title for the violation (e.g., "Obsolete Charge-Off").
-    - `description`: A detailed explanation of why it's a violation, referencing the specific data points.
-    - `affected_account`: The creditor name and account number (if applicable).
-    - `legal_basis`: Reference to the relevant FCRA section (e.g., "FCRA 605(a)" for obsolete info, "FCRA 623(a)" for furnisher accuracy) or Metro 2 rule.
-    - `severity`: "LOW", "MEDIUM", "HIGH", or "CRITICAL".
-    - `dispute_reason`: A brief reason for dispute (e.g., "Information is obsolete").
-
-    Return a JSON array of violation objects. If no violations are found, return an empty array `[]`.
-
-    Credit Report Data:
-    {data_str}
-    """
-    
     try:
-        response = model.generate_content(prompt)
-        json_str = response.text.strip()
-        if json_str.startswith("```json") and json_str.endswith("```"):
-            json_str = json_str[7:-3].strip()
-        elif json_str.startswith("```") and json_str.endswith("```"):
-            json_str = json_str[3:-3].strip()
-        
-        violations = json.loads(json_str)
+        response_text = await generate_content_cached(gemini_violations_model, prompt)
+        violations = [violation.model_dump(mode="json") for violation in violation_list_adapter.validate_json(response_text)]
         logger.info(f"Violation detection with Gemini successful. Found {len(violations)} violations.")
         return violations
     except Exception as e:
-        logger.error(f"Error detecting violations with Gemini: {e}\nGemini Response: {response.text if 'response' in locals() else 'N/A'}")
+        logger.error(f"Error detecting violations with Gemini: {e}\nGemini Response: {response_text if 'response_text' in locals() else 'N/A'}")
         raise
 
-def generate_dispute_letter_with_gemini(personal_info: dict, violations: list[dict]) -> str:
-    """Generates a dispute letter using Gemini based on detected violations."""
+async def generate_dispute_letter_with_gemini(personal_info: dict, violations: list[dict],
+                                              on_chunk: Callable[[str], None] | None = None) -> str:
+    """Generates a dispute letter using Gemini based on detected violations, optionally streaming it to `on_chunk`."""
     logger.info("Generating dispute letter with Gemini...")
-    model = genai.GenerativeModel("gemini-pro")
+    prompt = (
+        LETTER_PROMPT_PREFIX + PROMPT_DATA_SEPARATOR
+        + "Personal Information:\n" + compact_json(personal_info)
+        + "\n\nViolations to Dispute:\n" + compact_json(violations)
+    )
+
+    try:
+        response_text = await generate_content_cached(gemini_text_model, prompt, on_chunk=on_chunk)
+        logger.info("Dispute letter generation successful.")
+        return response_text
+    except Exception as e:
+        logger.error(f"Error generating dispute letter with Gemini: {e}")
+        raise
 
-    violations_str = json.dumps(violations, indent=2)
-    personal_info_str = json.dumps(personal_info, indent=2)
+def _rule_violation(violation_type: ViolationType, severity: ViolationSeverity, title: str, description: str,
+                    account: dict, legal_basis: str, dispute_reason: str) -> dict:
+    return Violation(
+        violation_type=violation_type,
+        severity=severity,
+        title=title,
+        description=description,
+        affected_account=f"{account['creditor_name']} {account['account_number']}".strip(),
+        legal_basis=legal_basis,
+        dispute_reason=dispute_reason,
+    ).model_dump(mode="json")
 
-    prompt = f"""
-    Generate a formal dispute letter to a credit bureau based on the following personal information and detected credit report violations.
+def rule_based_violations(parsed: dict) -> list[dict]:
+    """Detects the deterministic FCRA violations (obsolete, duplicate, inconsistent and incomplete accounts) without Gemini."""
+    violations = []
+    today = date.today()
+    seen_accounts: dict[tuple[str, str], int] = {}
 
-    Personal Information:
-    {personal_info_str}
+    for account in parsed.get("accounts", []):
+        status = account["status"]
 
-    Violations to Dispute:
-    {violations_str}
+        # (a) Negative information older than the 7-year reporting period
+        try:
+            last_activity = datetime.strptime(account["last_activity"], "%m/%d/%Y").date()
+        except ValueError:
+            last_activity = None
+        if last_activity and status in NEGATIVE_ACCOUNT_STATUSES and (today - last_activity).days > OBSOLETE_AFTER_DAYS:
+            violations.append(_rule_violation(
+                ViolationType.FCRA_OBSOLETE_INFO, ViolationSeverity.HIGH, "Obsolete Negative Information",
+                f"The account is reported as {status} with last activity on {account['last_activity']}, "
+                f"which is beyond the 7-year reporting period.",
+                account, "FCRA 605(a)", "Information is obsolete",
+            ))
 
-    The letter should:
-    - Be addressed to a generic credit bureau (e.g., "To: [Credit Bureau Name]").
-    - Clearly state the consumer's name and SSN.
-    - Reference the Fair Credit Reporting Act (FCRA).
-    - List each violation with its description, affected account, and legal basis.
-    - Request investigation and removal/correction of inaccurate information.
-    - Include a closing statement for prompt attention.
-    - Do NOT include placeholders for signature or printed name at the end, as the user will add those.
+        # (b) Same creditor and account number reported more than once
+        key = (account["creditor_name"].strip().upper(), account["account_number"].strip())
+        if all(key):
+            seen_accounts[key] = seen_accounts.get(key, 0) + 1
+            if seen_accounts[key] == 2:
+                violations.append(_rule_violation(
+                    ViolationType.DUPLICATE_ACCOUNT, ViolationSeverity.MEDIUM, "Duplicate Account",
+                    f"The {account['creditor_name']} account {account['account_number']} is reported more than once on this report.",
+                    account, "FCRA 607(b)", "Account is reported more than once",
+                ))
+
+        # (c) A paid-down account cannot still be delinquent
+        if account["balance"] == 0 and "late" in status:
+            violations.append(_rule_violation(
+                ViolationType.FCRA_ACCURACY, ViolationSeverity.MEDIUM, "Late Status on Zero-Balance Account",
+                f"The account has a zero balance but is reported as {status}.",
+                account, "FCRA 623(a)", "Account status is inaccurate",
+            ))
+
+        # (d) Required fields left empty by the furnisher
+        missing_fields = [field for field in REQUIRED_ACCOUNT_FIELDS if not str(account[field]).strip()]
+        if missing_fields:
+            violations.append(_rule_violation(
+                ViolationType.FCRA_INCOMPLETE_INFO, ViolationSeverity.LOW, "Incomplete Account Information",
+                f"The account is missing: {', '.join(field.replace('_', ' ') for field in missing_fields)}.",
+                account, "FCRA 623(a)", "Information is incomplete",
+            ))
+
+    return violations
+
+# --- Supabase Persistence --- #
+
+# Concurrent invocations on one instance share a single PostgREST array insert per batch. Rows
+# nobody waits on are written after the HTTP response has been sent, so this needs an instance
+# whose CPU stays allocated between requests (see README).
+INSERT_BATCH_MAX_ROWS = 20
+INSERT_BATCH_MAX_WAIT_SECONDS = 0.05
+
+insert_queue: asyncio.Queue = asyncio.Queue()
+_insert_flusher: asyncio.Task | None = None
+
+async def _flush_analysis_inserts() -> None:
+    """Drains insert_queue, writing up to INSERT_BATCH_MAX_ROWS rows per request."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await insert_queue.get()]
+        deadline = loop.time() + INSERT_BATCH_MAX_WAIT_SECONDS
+        while len(batch) < INSERT_BATCH_MAX_ROWS:
+            try:
+                batch.append(await asyncio.wait_for(insert_queue.get(), max(0.0, deadline - loop.time())))
+            except TimeoutError:
+                break
+
+        try:
+            await _insert_analysis_batch(batch)
+            logger.info(f"Stored {len(batch)} analysis rows in Supabase.")
+        except httpx.HTTPStatusError as e:
+            if len(batch) == 1 or not e.response.is_client_error:
+                _fail_analysis_batch(batch, e)
+                continue
+            # PostgREST rejected the whole array (one bad row fails the statement), so nothing was
+            # stored. Insert the rows one at a time so a bad row only fails its own request.
+            logger.warning(f"Batched Supabase insert of {len(batch)} rows failed ({e}); inserting rows individually.")
+            for item in batch:
+                try:
+                    await _insert_analysis_batch([item])
+                except Exception as row_error:
+                    _fail_analysis_batch([item], row_error)
+        except Exception as e:
+            # Not retried: a timed-out insert may still have committed, and a retry would store the rows twice
+            _fail_analysis_batch(batch, e)
+
+async def _insert_analysis_batch(batch: list[tuple[dict, asyncio.Future | None]]) -> None:
+    """Inserts the batch's rows in one PostgREST request and resolves the futures of callers waiting on them."""
+    # Only ask PostgREST to echo the rows back when a caller is waiting for one
+    return_records = any(future for _, future in batch)
+    response = await http_client.post(
+        f"{SUPABASE_REST_URL}/credit_reports_analysis",
+        content=orjson.dumps([row for row, _ in batch]),
+        headers={
+            **SUPABASE_REST_HEADERS,
+            "Content-Type": "application/json",
+            "Prefer": "return=representation" if return_records else "return=minimal",
+        },
+    )
+    response.raise_for_status()
+    if return_records:
+        # PostgREST returns inserted rows in request order
+        for (_, future), record in zip(batch, orjson.loads(response.content)):
+            if future:
+                future.set_result(record)
+
+def _fail_analysis_batch(batch: list[tuple[dict, asyncio.Future | None]], error: Exception) -> None:
+    logger.error(f"Supabase insert of {len(batch)} analysis rows failed: {error}")
+    for _, future in batch:
+        if future and not future.done():
+            future.set_exception(error)
+
+async def insert_analysis_row(row: dict, return_record: bool = True) -> dict | None:
+    """Queues a credit_reports_analysis row for the next batched insert.
+
+    With `return_record`, waits for the insert and returns the stored record; otherwise returns
+    immediately and the row is written in the background.
+    """
+    global _insert_flusher
+    if _insert_flusher is None or _insert_flusher.done():
+        _insert_flusher = asyncio.create_task(_flush_analysis_inserts())
+
+    future = asyncio.get_running_loop().create_future() if return_record else None
+    insert_queue.put_nowait((row, future))
+    return await future if future else None
+
+async def find_existing_analysis(user_id: str, column: str, value: str) -> dict | None:
+    """Returns this user's most recent stored analysis row whose `column` equals `value`, if there is one."""
+    response = await call_with_retries(
+        http_client.get,
+        f"{SUPABASE_REST_URL}/credit_reports_analysis",
+        params={
+            "select": "*",
+            "user_id": f"eq.{user_id}",
+            column: f"eq.{value}",
+            "order": "processed_at.desc",
+            "limit": "1",
+        },
+        headers=SUPABASE_REST_HEADERS,
+    )
+    response.raise_for_status()
+    rows = orjson.loads(response.content)
+    return rows[0] if rows else None
+
+# --- Processing Pipeline --- #
+
+# Bounded hand-off between pipeline stages, so a fast stage cannot run far ahead of a slow one
+PIPELINE_QUEUE_SIZE = 4
+# A parse batch is sent to Gemini once it holds this many pages...
+PARSE_BATCH_PAGES = 5
+# ...or once its oldest page has waited this long for more to arrive
+PARSE_BATCH_MAX_WAIT_SECONDS = 0.25
+
+async def parse_worker(page_queue: asyncio.Queue, pages: list[tuple[int, str]],
+                       parsed_batches: list[tuple[int, dict]]) -> None:
+    """Collects OCR'd pages into batches and parses each batch with Gemini as soon as it is full or stale.
+
+    Vision finishes page windows out of order, so a page is held back until every earlier page has
+    arrived. Batches are therefore runs of consecutive pages, and an account cut off at the end of
+    one batch continues at the start of the next (see merge_parsed_batches).
     """
+    loop = asyncio.get_running_loop()
+
+    async def parse_batch(batch: list[tuple[int, str]]) -> None:
+        partial = await parse_credit_report_with_gemini("\n".join(text for _, text in batch))
+        parsed_batches.append((batch[0][0], partial))
+
+    async with asyncio.TaskGroup() as tg:
+        batch: list[tuple[int, str]] = []
+        deadline = 0.0
+        held_pages: dict[int, str] = {}
+        next_page = 1
+        while True:
+            try:
+                timeout = max(0.0, deadline - loop.time()) if batch else None
+                item = await asyncio.wait_for(page_queue.get(), timeout)
+            except TimeoutError:
+                tg.create_task(parse_batch(batch))
+                batch = []
+                continue
+
+            if item is None:
+                break
+            pages.append(item)
+            held_pages[item[0]] = item[1]
+            while next_page in held_pages:
+                page_number, text = next_page, held_pages.pop(next_page)
+                next_page += 1
+                if not text:
+                    continue  # Blank page; nothing for Gemini to parse
+
+                batch.append((page_number, text))
+                if len(batch) == 1:
+                    deadline = loop.time() + PARSE_BATCH_MAX_WAIT_SECONDS
+                if len(batch) >= PARSE_BATCH_PAGES:
+                    tg.create_task(parse_batch(batch))
+                    batch = []
+
+        batch += [(page_number, text) for page_number, text in sorted(held_pages.items()) if text]
+        if batch:
+            tg.create_task(parse_batch(batch))
+
+def _continues_account(previous: dict, account: dict) -> bool:
+    """Whether `account`, first in its parse batch, is the remainder of `previous`, last in the batch before."""
+    if all(str(previous[field]).strip() and str(account[field]).strip() for field in REQUIRED_ACCOUNT_FIELDS):
+        return False  # Two complete records are two listings, not one split across pages
+    for field in ("creditor_name", "account_number"):
+        previous_value, value = previous[field].strip().upper(), account[field].strip().upper()
+        if previous_value and value and previous_value != value:
+            return False
+    return True
+
+def merge_parsed_batches(parsed_batches: list[dict]) -> dict:
+    """Combines per-batch parse results, given in page order, into a single credit report.
+
+    An account split across a batch boundary comes back as two partial records; they are joined
+    so the rules do not report it as a duplicate with missing fields.
+    """
+    merged = {"personal_info": {}, "accounts": [], "inquiries": []}
+    for partial in parsed_batches:
+        for field, value in (partial.get("personal_info") or {}).items():
+            if value and not merged["personal_info"].get(field):
+                merged["personal_info"][field] = value
+        accounts = [dict(account) for account in partial.get("accounts", [])]
+        if accounts and merged["accounts"] and _continues_account(merged["accounts"][-1], accounts[0]):
+            previous = merged["accounts"][-1]
+            for field, value in accounts.pop(0).items():
+                if value and not previous[field]:
+                    previous[field] = value
+        merged["accounts"].extend(accounts)
+        merged["inquiries"].extend(partial.get("inquiries", []))
+    return merged
+
+async def process_credit_report_async(pdf_url: str, user_id: str, return_record: bool = True,
+                                      on_letter_chunk: Callable[[str], None] | None = None,
+                                      reprocess: bool = False) -> dict:
+    """Runs the download, OCR, analysis and storage steps for one credit report.
+
+    By default the stored row is waited for and included as `data`. Without `return_record`, the
+    row is written in the background after the result is returned.
+    With `reprocess`, a PDF this user already submitted is analyzed again (reusing its cached OCR
+    text) and stored as a new row instead of returning the earlier analysis.
+    """
+    cache_user_id.set(user_id)
+
+    # 0. Retried webhooks and re-submissions of the same upload skip the whole pipeline
+    existing_analysis = None if reprocess else await find_existing_analysis(user_id, "pdf_url", pdf_url)
+    if existing_analysis:
+        logger.info(f"PDF already processed for this user (analysis {existing_analysis['id']}).")
+        return existing_analysis_result(existing_analysis, on_letter_chunk)
+
+    # 1. Download PDF content from Supabase Storage
+    logger.info("Downloading PDF from Supabase Storage...")
+    pdf_input, staged_blob, pdf_sha256 = await download_pdf(pdf_url)
+
+    # 2-3. OCR and parse as a streaming pipeline: Gemini starts on the first pages while Vision
+    # is still working through the rest of the document
+    logger.info("Starting OCR -> parse pipeline...")
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    pages: list[tuple[int, str]] = []
+    parsed_batches: list[tuple[int, dict]] = []
+
     try:
-        response = model.generate_content(prompt)
-        logger.info("Dispute letter generation successful.")
-        return response.text
-    except Exception as e:
-        logger.error(f"Error generating dispute letter with Gemini: {e}")
-        raise
+        # The same file uploaded again under a new URL is caught by its content hash
+        existing_analysis = None if reprocess else await find_existing_analysis(user_id, "pdf_sha256", pdf_sha256)
+        if existing_analysis:
+            logger.info(f"Identical PDF already processed for this user (analysis {existing_analysis['id']}).")
+            return existing_analysis_result(existing_analysis, on_letter_chunk)
+
+        # Reprocessing a known PDF (e.g. after a prompt change) reuses its OCR text
+        cached_page_texts = await load_cached_ocr_pages(pdf_sha256)
+        if cached_page_texts is not None:
+            logger.info("Using cached OCR text; skipping Vision AI.")
+
+        async with asyncio.TaskGroup() as tg:
+            if cached_page_texts is not None:
+                tg.create_task(queue_cached_ocr_pages(cached_page_texts, page_queue))
+            else:
+                tg.create_task(extract_pages_from_pdf_with_vision_ai(pdf_input, page_queue))
+            tg.create_task(parse_worker(page_queue, pages, parsed_batches))
+    finally:
+        # Also reached on a dedup or OCR cache hit, which needs no staged copy
+        if staged_blob:
+            await asyncio.to_thread(staged_blob.delete)
+
+    extracted_text = "\n".join(text for _, text in sorted(pages) if text)
+    if not extracted_text:
+        raise ValueError("Could not extract text from PDF.")
+
+    # Save the OCR output while the dispute letter is generated
+    ocr_cache_store = None
+    if cached_page_texts is None:
+        ocr_cache_store = asyncio.create_task(store_cached_ocr_pages(pdf_sha256, [text for _, text in sorted(pages)]))
+
+    parsed_credit_report = merge_parsed_batches([partial for _, partial in sorted(parsed_batches, key=lambda item: item[0])])
+
+    # 4. Detect violations over the merged report, so accounts split across parse batches are whole
+    # again and personal information is reviewed once, in full
+    logger.info("Detecting violations...")
+    detected_violations = rule_based_violations(parsed_credit_report) + await detect_violations_with_gemini(parsed_credit_report)
+
+    # 5. Generate dispute letter with Gemini
+    logger.info("Generating dispute letter...")
+    dispute_letter = await generate_dispute_letter_with_gemini(
+        parsed_credit_report.get("personal_info", {}),
+        detected_violations,
+        on_chunk=on_letter_chunk,
+    )
+
+    if ocr_cache_store:
+        await ocr_cache_store
+
+    # 6. Store results in Supabase
+    logger.info("Storing results in Supabase...")
+    
+    # Prepare data for Supabase insertion
+    supabase_data = {
+        "user_id": user_id,
+        "pdf_url": pdf_url,
+        "pdf_sha256": pdf_sha256,
+        "extracted_text": extracted_text,
+        "parsed_data": parsed_credit_report,  # Store as JSONB
+        "violations": detected_violations,    # Store as JSONB
+        "dispute_letter": dispute_letter,
+        "processed_at": datetime.now().isoformat()
+    }
+
+    # Insert into Supabase
+    stored_record = await insert_analysis_row(supabase_data, return_record=return_record)
+
+    result = {
+        "status": "success",
+        "message": "Credit report processed successfully",
+        "summary": {
+            "violations_found": len(detected_violations),
+            "accounts_analyzed": len(parsed_credit_report.get("accounts", [])),
+            "inquiries_found": len(parsed_credit_report.get("inquiries", []))
+        }
+    }
+    if stored_record is not None:
+        logger.info(f"Results stored in Supabase: {stored_record.get('id')}")
+        result["data"] = [stored_record]
+    return result
+
+def existing_analysis_result(analysis: dict, on_letter_chunk: Callable[[str], None] | None = None) -> dict:
+    """Builds the success response for a report that was already processed."""
+    if on_letter_chunk and analysis["dispute_letter"]:
+        on_letter_chunk(analysis["dispute_letter"])
+    return {
+        "status": "success",
+        "message": "Credit report already processed",
+        "cached": True,
+        "data": [analysis],
+        "summary": {
+            "violations_found": len(analysis["violations"]),
+            "accounts_analyzed": len(analysis["parsed_data"].get("accounts", [])),
+            "inquiries_found": len(analysis["parsed_data"].get("inquiries", []))
+        }
+    }
+
+def stream_dispute_letter(pdf_url: str, user_id: str, reprocess: bool = False) -> Response:
+    """Processes a credit report and streams the dispute letter to the client as Gemini writes it.
+
+    Raises if the pipeline fails before the first letter chunk, so the caller can still answer
+    with a regular JSON error.
+    """
+    letter_chunks: queue.Queue = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        process_credit_report_async(pdf_url, user_id, on_letter_chunk=letter_chunks.put_nowait, reprocess=reprocess),
+        get_event_loop(),
+    )
+    future.add_done_callback(lambda _: letter_chunks.put_nowait(None))
+
+    first_chunk = letter_chunks.get()
+    if first_chunk is None:
+        future.result()  # Raises if processing failed
+        return Response("", mimetype="text/plain")
+
+    def generate():
+        yield first_chunk
+        while (chunk := letter_chunks.get()) is not None:
+            yield chunk
+        try:
+            future.result()
+        except Exception as e:
+            # Headers are already sent; the letter is complete but the caller cannot be told
+            logger.error(f"Processing error after streaming the dispute letter: {e}", exc_info=True)
+
+    return Response(stream_with_context(generate()), mimetype="text/plain")
 
 # --- GCF Entry Point --- #
 
@@ -299,70 +1072,28 @@ def process_credit_report(request):
 
     if not pdf_url or not user_id:
         logger.error("Missing 'pdf_url' or 'user_id' in request.")
-        return json.dumps({"status": "error", "message": "Missing pdf_url or user_id"}), 400
+        return orjson.dumps({"status": "error", "message": "Missing pdf_url or user_id"}), 400
 
     logger.info(f"Processing PDF from URL: {pdf_url} for user: {user_id}")
 
     try:
-        # 1. Download PDF content from Supabase Storage
-        logger.info("Downloading PDF from Supabase Storage...")
-        pdf_response = requests.get(pdf_url, timeout=30)
-        pdf_response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
-        pdf_content = pdf_response.content
-        logger.info(f"Downloaded PDF content (size: {len(pdf_content)} bytes).")
-
-        # 2. Extract text using Google Cloud Vision AI
-        logger.info("Starting text extraction...")
-        extracted_text = extract_text_from_pdf_with_vision_ai(pdf_content)
-        if not extracted_text:
-            raise ValueError("Could not extract text from PDF.")
-        
-        # 3. Parse credit report with Gemini
-        logger.info("Starting credit report parsing...")
-        parsed_credit_report = parse_credit_report_with_gemini(extracted_text)
-        if not parsed_credit_report:
-            raise ValueError("Could not parse credit report data.")
-
-        # 4. Detect violations with Gemini
-        logger.info("Starting violation detection...")
-        detected_violations = detect_violations_with_gemini(parsed_credit_report)
-
-        # 5. Generate dispute letter with Gemini
-        logger.info("Generating dispute letter...")
-        dispute_letter = generate_dispute_letter_with_gemini(
-            parsed_credit_report.get("personal_info", {}),
-            detected_violations
-        )
+        # Re-running the analysis (e.g. after a prompt change) skips the already-processed lookups
+        reprocess = bool(request_json.get("reprocess"))
 
-        # 6. Store results in Supabase
-        logger.info("Storing results in Supabase...")
-        
-        # Prepare data for Supabase insertion
-        supabase_data = {
-            "user_id": user_id,
-            "pdf_url": pdf_url,
-            "extracted_text": extracted_text,
-            "parsed_data": parsed_credit_report,  # Store as JSONB
-            "violations": detected_violations,    # Store as JSONB
-            "dispute_letter": dispute_letter,
-            "processed_at": datetime.now().isoformat()
-        }
+        # Clients that only need the letter can opt into receiving it as a text stream
+        if request_json.get("stream_letter"):
+            return stream_dispute_letter(pdf_url, user_id, reprocess=reprocess)
 
-        # Insert into Supabase
-        response = supabase.table("credit_reports_analysis").insert(supabase_data).execute()
-        logger.info(f"Results stored in Supabase: {response.data}")
-
-        return json.dumps({
-            "status": "success", 
-            "message": "Credit report processed successfully", 
-            "data": response.data,
-            "summary": {
-                "violations_found": len(detected_violations),
-                "accounts_analyzed": len(parsed_credit_report.get("accounts", [])),
-                "inquiries_found": len(parsed_credit_report.get("inquiries", []))
-            }
-        }), 200
+        # Writing the row in the background is opt-in: it needs CPU allocated after the response (see README)
+        return_record = bool(request_json.get("return_record", True))
+        result = run_async(process_credit_report_async(
+            pdf_url, user_id, return_record=return_record, reprocess=reprocess
+        ))
+        return orjson.dumps(result), 200
 
     except Exception as e:
         logger.error(f"Overall processing error: {e}", exc_info=True)
-        return json.dumps({"status": "error", "message": str(e)}), 500 
\ No newline at end of file
+        # TaskGroup failures arrive wrapped in (possibly nested) exception groups
+        while isinstance(e, ExceptionGroup):
+            e = e.exceptions[0]
+        return orjson.dumps({"status": "error", "message": str(e)}), 500 
\ No newline at end of file
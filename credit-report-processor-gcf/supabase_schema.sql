@@ -9,6 +9,7 @@ CREATE TABLE IF NOT EXISTS credit_reports_analysis (
     id UUID DEFAULT uuid_generate_v4() PRIMARY KEY,
     user_id UUID NOT NULL REFERENCES auth.users(id) ON DELETE CASCADE,
     pdf_url TEXT NOT NULL,
+    pdf_sha256 TEXT,
     extracted_text TEXT NOT NULL,
     parsed_data JSONB NOT NULL,
     violations JSONB NOT NULL DEFAULT '[]'::jsonb,
@@ -21,6 +22,11 @@ CREATE TABLE IF NOT EXISTS credit_reports_analysis (
 -- Index for faster queries
 CREATE INDEX IF NOT EXISTS idx_credit_reports_analysis_user_id ON credit_reports_analysis(user_id);
 CREATE INDEX IF NOT EXISTS idx_credit_reports_analysis_processed_at ON credit_reports_analysis(processed_at);
+CREATE INDEX IF NOT EXISTS idx_credit_reports_analysis_user_pdf_url ON credit_reports_analysis(user_id, pdf_url);
+
+-- Existing deployments: add the content hash used to skip reprocessing identical PDFs
+ALTER TABLE credit_reports_analysis ADD COLUMN IF NOT EXISTS pdf_sha256 TEXT;
+CREATE INDEX IF NOT EXISTS idx_credit_reports_analysis_user_pdf_sha256 ON credit_reports_analysis(user_id, pdf_sha256);
 
 -- Violation Summary View
 CREATE OR REPLACE VIEW credit_report_violation_summary AS
@@ -129,6 +135,26 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Gemini Response Cache
+-- Responses are matched exactly by cache_key (SHA-256 of model + prompt).
+CREATE TABLE IF NOT EXISTS gemini_response_cache (
+    cache_key TEXT PRIMARY KEY,
+    user_id UUID REFERENCES auth.users(id) ON DELETE CASCADE,
+    response_text TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+ALTER TABLE gemini_response_cache ENABLE ROW LEVEL SECURITY;
+
+-- Only the Google Cloud Function reads and writes the cache
+CREATE POLICY "Service role can manage Gemini cache" ON gemini_response_cache
+    FOR ALL USING (auth.role() = 'service_role');
+
+-- Private Storage bucket for cached OCR text, keyed by the PDF's SHA-256
+INSERT INTO storage.buckets (id, name, public)
+VALUES ('ocr-cache', 'ocr-cache', false)
+ON CONFLICT (id) DO NOTHING;
+
 -- Grant necessary permissions
 GRANT USAGE ON SCHEMA public TO anon, authenticated, service_role;
 GRANT ALL ON ALL TABLES IN SCHEMA public TO anon, authenticated, service_role;
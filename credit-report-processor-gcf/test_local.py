@@ -5,7 +5,7 @@ Local testing script for the Credit Report Processor Google Cloud Function
 
 import os
 import json
-import requests
+import httpx
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -30,7 +30,7 @@ def test_function_locally():
     print()
     
     try:
-        response = requests.post(
+        response = httpx.post(
             local_url,
             json=test_payload,
             headers={"Content-Type": "application/json"},
@@ -59,12 +59,12 @@ def test_function_locally():
             print("❌ Error!")
             print(f"Error Response: {response.text}")
             
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print("❌ Connection Error!")
         print("Make sure the function is running locally with:")
         print("  functions-framework --target=process_credit_report --port=8080")
         
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print("❌ Timeout Error!")
         print("The function took too long to respond.")
         
@@ -121,12 +121,14 @@ def test_supabase_connection():
         return False
     
     try:
-        from supabase import create_client
-        
-        supabase = create_client(supabase_url, supabase_key)
-        
-        # Test connection by querying a simple table
-        response = supabase.table("credit_reports_analysis").select("id").limit(1).execute()
+        # Test connection by querying a simple table through PostgREST, as the function does
+        response = httpx.get(
+            f"{supabase_url}/rest/v1/credit_reports_analysis",
+            params={"select": "id", "limit": "1"},
+            headers={"apikey": supabase_key, "Authorization": f"Bearer {supabase_key}"},
+            timeout=30
+        )
+        response.raise_for_status()
         
         print("✅ Supabase connection successful")
         return True